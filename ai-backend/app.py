@@ -1,23 +1,33 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 import torch
-from PIL import Image
-import io
-import json
+import numpy as np
+import cv2
+from torchvision.io import decode_jpeg, ImageReadMode
+import asyncio
+import orjson
+import aiofiles
+from blake3 import blake3
+from cachetools import LRUCache
 from typing import List, Dict
 import logging
 from datetime import datetime
 import os
-import shutil
+import sys
 import pathlib
+import inspect
+import types
+import subprocess
+import time
+import warnings
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Object Detection AI Backend", version="1.0.0")
+app = FastAPI(title="Object Detection AI Backend", version="1.0.0", default_response_class=ORJSONResponse)
 
 BASE_DIR = pathlib.Path(__file__).resolve().parent
 
@@ -29,6 +39,10 @@ JSON_DIR = RESULTS_DIR / "json"
 
 RESULTS_DIR_STR = str(RESULTS_DIR) # Keep for legacy use if needed
 
+MODELS_DIR = BASE_DIR / "models"
+WEIGHTS_PATH = MODELS_DIR / "yolov5n.pt"
+ENGINE_PATH = MODELS_DIR / "yolov5n.engine"
+
 os.makedirs(RESULTS_DIR, exist_ok=True)
 
 # Mount static files
@@ -44,25 +58,226 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Dynamic micro-batching settings
+MAX_BATCH = 16          # Max images coalesced into one forward pass
+BATCH_TIMEOUT = 0.005   # Seconds to wait for more requests after the first
+IMG_SIZE = 640          # Inference size
+WARMUP_BATCHES = (1, 4, 8, 16)  # Batch sizes primed at startup
+BENCHMARK_RUNS = 20     # Timed forwards when comparing TensorRT vs PyTorch at startup
+CONF_THRESHOLD = 0.25   # Confidence threshold
+IOU_THRESHOLD = 0.45    # NMS IoU threshold
+MAX_DET = 1000          # Max detections per image
+
+# Detection results keyed by BLAKE3 hash of the uploaded bytes
+RESULT_CACHE_SIZE = 1024
+
+# decode_jpeg only applies EXIF orientation from torchvision 0.16; older versions decode JPEGs with PIL
+JPEG_EXIF_SUPPORTED = 'apply_exif_orientation' in inspect.signature(decode_jpeg).parameters
+result_cache = LRUCache(maxsize=RESULT_CACHE_SIZE)
+
 # Global model variable
 model = None
+hub = None            # YOLOv5 helpers (letterbox, NMS, Detections) from the hub repo
+pinned_batch = None   # Pinned host staging buffer for CUDA uploads
+copy_stream = None    # Dedicated CUDA stream for host-to-device copies
+batch_queue = None
+batch_worker = None
+background_tasks = set()  # Pending result writes, referenced until done
 
 @app.on_event("startup")
 async def load_model():
     """Load the YOLOv5 model on startup"""
-    global model
+    global model, hub, pinned_batch, copy_stream, batch_queue, batch_worker
     try:
         logger.info("Loading YOLOv5 model...")
         # Load YOLOv5n (nano) model from local directory
         #model = torch.hub.load(f'{BASE_DIR}/models/yolov3', 'yolov5n', source='local')
-        model = torch.hub.load('ultralytics/yolov3', 'yolov5n', pretrained=True)
-        model.conf = 0.25  # Confidence threshold
-        model.iou = 0.45   # IoU threshold
+        # Raw DetectMultiBackend without AutoShape; the batcher does its own pre/post-processing
+        model = torch.hub.load('ultralytics/yolov3', 'yolov5n', pretrained=True, autoshape=False)
+        # hubconf only fuses Conv+BN when autoshape=True, so fuse explicitly
+        model.model.fuse()
+        hub = resolve_hub_helpers()
+
+        if torch.cuda.is_available():
+            # Inputs are always IMG_SIZE x IMG_SIZE, so let cuDNN pick and cache the fastest kernels
+            torch.backends.cudnn.benchmark = True
+            torch.set_float32_matmul_precision('high')
+            # Run on GPU in half precision
+            model.cuda().half()
+            model.fp16 = True
+            logger.info("Model moved to CUDA (FP16)")
+            try:
+                engine = load_engine(model)
+                logger.info(f"TensorRT engine loaded: {ENGINE_PATH}")
+                # The engine is FP32 (see load_engine), so only use it if it actually beats FP16 PyTorch
+                pt_time, engine_time = benchmark_forward(model), benchmark_forward(engine)
+                logger.info(f"Batch-{MAX_BATCH} forward: PyTorch FP16 {pt_time * 1E3:.1f} ms, "
+                            f"TensorRT {engine_time * 1E3:.1f} ms")
+                if engine_time < pt_time:
+                    model = engine
+                    logger.info("Using TensorRT engine")
+                else:
+                    logger.info("Using PyTorch FP16 model")
+            except Exception as e:
+                logger.warning(f"TensorRT engine unavailable, using PyTorch model: {str(e)}")
+            pinned_batch = torch.empty((MAX_BATCH, 3, IMG_SIZE, IMG_SIZE), dtype=torch.uint8, pin_memory=True)
+            copy_stream = torch.cuda.Stream()
+            # Warm-up forwards so cuDNN autotuning/TensorRT setup doesn't land on requests
+            dtype = torch.half if model.fp16 else torch.float
+            with torch.inference_mode():
+                for batch_size in WARMUP_BATCHES:
+                    model(torch.zeros(batch_size, 3, IMG_SIZE, IMG_SIZE, device='cuda', dtype=dtype))
+
         logger.info("Model loaded successfully")
+
+        # Start the request-coalescing worker
+        batch_queue = asyncio.Queue()
+        batch_worker = asyncio.create_task(run_batch_worker())
     except Exception as e:
         logger.error(f"Error loading model: {str(e)}")
         raise
 
+def resolve_hub_helpers():
+    """
+    Look up the YOLOv5 pre/post-processing helpers from their defining hub repo modules
+    
+    torch.hub.load imports the repo's utils/models packages while loading the
+    model; resolving the helpers once here makes a missing name fail at startup
+    instead of on the first request.
+    """
+    try:
+        return types.SimpleNamespace(
+            letterbox=sys.modules['utils.augmentations'].letterbox,
+            non_max_suppression=sys.modules['utils.general'].non_max_suppression,
+            scale_boxes=sys.modules['utils.general'].scale_boxes,
+            Profile=sys.modules['utils.general'].Profile,
+            Detections=sys.modules['models.common'].Detections,
+        )
+    except (KeyError, AttributeError) as e:
+        raise RuntimeError(f"YOLOv5 hub helpers not available: {str(e)}") from e
+
+def benchmark_forward(m) -> float:
+    """Mean seconds per CUDA forward pass at MAX_BATCH, after one untimed pass"""
+    x = torch.zeros(MAX_BATCH, 3, IMG_SIZE, IMG_SIZE, device='cuda', dtype=torch.half if m.fp16 else torch.float)
+    with torch.inference_mode():
+        m(x)
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(BENCHMARK_RUNS):
+            m(x)
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / BENCHMARK_RUNS
+
+def load_engine(pt_model):
+    """
+    Load the YOLOv5n TensorRT engine, exporting it from the local weights on first use
+    
+    The engine is built with a dynamic batch profile (1..MAX_BATCH) at a fixed
+    IMG_SIZE so the batching worker can feed it any batch size. export.py
+    rejects --half together with --dynamic, so the engine is FP32.
+    """
+    if not ENGINE_PATH.exists():
+        # export.py lives in the hub repo the PyTorch model was loaded from
+        repo_dir = pathlib.Path(inspect.getfile(type(pt_model))).parents[1]
+        logger.info("Exporting TensorRT engine (one-time)...")
+        subprocess.run([
+            sys.executable, str(repo_dir / 'export.py'),
+            '--weights', str(WEIGHTS_PATH),
+            '--include', 'engine',
+            '--device', '0',
+            '--dynamic',
+            '--batch-size', str(MAX_BATCH),
+            '--imgsz', str(IMG_SIZE),
+        ], check=True)
+    engine = torch.hub.load('ultralytics/yolov3', 'custom', path=str(ENGINE_PATH), autoshape=False)
+    # Engines carry no class metadata (DetectMultiBackend falls back to 'class0'...), so keep the COCO labels
+    engine.names = pt_model.names
+    return engine
+
+@app.on_event("shutdown")
+async def stop_batch_worker():
+    """Stop the batching worker on shutdown"""
+    if batch_worker is not None:
+        batch_worker.cancel()
+
+async def run_batch_worker():
+    """
+    Gather concurrently pending /detect requests into a single model call
+    
+    Waits for the first queued image, then collects more for up to
+    BATCH_TIMEOUT seconds (or until MAX_BATCH) before running one forward pass.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + BATCH_TIMEOUT
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        images = [image for image, _ in batch]
+        try:
+            outputs = await asyncio.to_thread(predict_batch, images)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+
+        for (_, future), output in zip(batch, outputs):
+            if not future.done():
+                future.set_result(output)
+
+def predict_batch(images) -> List[tuple]:
+    """
+    Run detection on a list of images in one forward pass
+    
+    Returns:
+        (detections, rendered image array) for each input image
+    """
+    logger.info(f"Running batch of {len(images)} image(s)")
+    dt = (hub.Profile(), hub.Profile(), hub.Profile())
+    with dt[0]:
+        x = stage_batch(images)
+    with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16, enabled=x.is_cuda):
+        with dt[1]:
+            pred = model(x)
+        with dt[2]:
+            pred = hub.non_max_suppression(pred, CONF_THRESHOLD, IOU_THRESHOLD, max_det=MAX_DET)
+            for image, det in zip(images, pred):
+                hub.scale_boxes(x.shape[2:], det[:, :4], image.shape)
+
+        files = [f'image{i}.jpg' for i in range(len(images))]
+        results = hub.Detections(images, pred, files, times=dt, names=model.names, shape=x.shape)
+    rendered = results.render()
+    return [(parse_results(results, i), rendered[i]) for i in range(len(images))]
+
+def stage_batch(images) -> torch.Tensor:
+    """
+    Letterbox images to IMG_SIZE and upload them as one normalized (N, 3, H, W) batch
+    
+    On CUDA the batch is filled into a pinned host buffer and copied with a
+    non-blocking transfer on copy_stream, then cast to the model's input dtype.
+    """
+    boxed = [hub.letterbox(image, IMG_SIZE, auto=False)[0] for image in images]
+    if pinned_batch is None:
+        x = torch.from_numpy(np.stack(boxed)).permute(0, 3, 1, 2)
+        return x.float() / 255
+
+    for i, im in enumerate(boxed):
+        pinned_batch[i].copy_(torch.from_numpy(im).permute(2, 0, 1))
+    with torch.cuda.stream(copy_stream):
+        x = pinned_batch[:len(boxed)].to('cuda', non_blocking=True)
+    compute_stream = torch.cuda.current_stream()
+    compute_stream.wait_stream(copy_stream)
+    x.record_stream(compute_stream)
+    return (x.half() if model.fp16 else x.float()) / 255
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -105,18 +320,22 @@ async def detect_objects(file: UploadFile = File(...)):
         
         # Read and process the image
         logger.info(f"Processing image: {file.filename}")
+        # Large uploads spill to disk, so read through the threadpool-backed async API
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Perform detection
-        results = model(image)
+
+        # Serve repeated uploads from the result cache
+        digest = blake3(contents).hexdigest()
+        cached = get_cached_result(digest)
+        if cached is not None:
+            logger.info(f"Cache hit: {digest}")
+            return ORJSONResponse(content={**cached, "image_name": file.filename})
+
+        image = decode_image(contents)
         
-        # Parse results for JSON response
-        detections = parse_results(results)
+        # Queue for batched detection and wait for this image's results
+        future = asyncio.get_running_loop().create_future()
+        await batch_queue.put((image, future))
+        detections, rendered = await future
         
         # Generate unique filename for result
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -124,21 +343,14 @@ async def detect_objects(file: UploadFile = File(...)):
         result_filename_img = f"result_{timestamp}_{base_name}.jpg"
         result_path_img = IMAGES_DIR / result_filename_img 
 
-
-        img_with_boxes = Image.fromarray(results.render()[0])
-
-
-        img_with_boxes.save(result_path_img)
-
         logger.info(f"Detected {len(detections)} objects")
-        logger.info(f"Result image saved: {result_path_img}")
         
         response_data = {
             "success": True,
             "image_name": file.filename,
             "image_size": {
-                "width": image.width,
-                "height": image.height
+                "width": image.shape[1],
+                "height": image.shape[0]
             },
             "detections_count": len(detections),
             "detections": detections,
@@ -146,63 +358,129 @@ async def detect_objects(file: UploadFile = File(...)):
             #"result_path": str(result_path_img),
             "timestamp": datetime.now().isoformat()
         }
-        # Save JSON result to file
+        # Serialize JSON result for the result file
         result_filename_json = f"result_{timestamp}_{base_name}.json"
         json_path = JSON_DIR / result_filename_json
-        json_path_str = str(json_path)
-        with open(json_path_str, 'w') as json_file:
-            json.dump(response_data, json_file, indent=4)
-        logger.info(f"JSON result saved: {json_path_str}")
+        json_bytes = orjson.dumps(response_data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+
         response_data["result_json"] = f"/static/results/json/{result_filename_json}"
-        return JSONResponse(content=response_data)
+
+        # Write result files in the background; clients fetch them later via /static
+        task = asyncio.create_task(persist_results(digest, response_data, rendered, json_bytes, result_path_img, json_path))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        return ORJSONResponse(content=response_data)
         
     except Exception as e:
         logger.error(f"Error during detection: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Detection failed: {str(e)}")
 
-def parse_results(results) -> List[Dict]:
+def get_cached_result(digest: str):
+    """
+    Return the cached response for an upload hash if its result image still exists
+    """
+    entry = result_cache.get(digest)
+    if entry is None:
+        return None
+    response_data, image_path = entry
+    if not image_path.exists():
+        result_cache.pop(digest, None)
+        return None
+    return response_data
+
+async def persist_results(digest: str, response_data: Dict, rendered: np.ndarray, json_bytes: bytes,
+                          image_path: pathlib.Path, json_path: pathlib.Path):
     """
-    Parse YOLO results into structured JSON format
+    Save the rendered result image and JSON result without blocking the event loop
+    
+    The response is cached only once its files are on disk.
     """
-    detections = []
+    try:
+        await asyncio.to_thread(save_result_image, rendered, image_path)
+        logger.info(f"Result image saved: {image_path}")
 
-    # Extract predictions
-    predictions = results.pandas().xyxy[0]
+        async with aiofiles.open(json_path, 'wb') as json_file:
+            await json_file.write(json_bytes)
+        logger.info(f"JSON result saved: {json_path}")
+
+        result_cache[digest] = (response_data, image_path)
+    except Exception as e:
+        logger.error(f"Error saving results: {str(e)}")
+
+def save_result_image(rendered: np.ndarray, image_path: pathlib.Path):
+    """Encode the rendered image as JPEG (libjpeg-turbo via OpenCV) and write it to disk"""
+    img_with_boxes = cv2.cvtColor(rendered, cv2.COLOR_RGB2BGR)
+    # cv2.imwrite reports failure by return value rather than raising
+    if not cv2.imwrite(str(image_path), img_with_boxes, [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 0]):
+        raise IOError(f"Failed to write {image_path}")
+
+def decode_image(contents: bytes) -> np.ndarray:
+    """
+    Decode uploaded image bytes into an RGB (H, W, 3) uint8 array
+    
+    JPEGs are decoded with torchvision's libjpeg-turbo decoder; other
+    formats (png, gif, bmp, webp) and JPEGs torchvision can't decode fall
+    back to PIL. EXIF orientation is applied in both paths, as AutoShape
+    did for PIL inputs.
+    """
+    if contents[:2] == b'\xff\xd8' and JPEG_EXIF_SUPPORTED:
+        # Wrap the read-only upload bytes without copying; decode_jpeg never writes to them
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="The given buffer is not writable")
+            raw = torch.frombuffer(contents, dtype=torch.uint8)
+        try:
+            image = decode_jpeg(raw, mode=ImageReadMode.RGB, apply_exif_orientation=True)
+            return image.permute(1, 2, 0).contiguous().numpy()
+        except RuntimeError as e:
+            # e.g. CMYK/YCCK or arithmetic-coded JPEGs; PIL can still decode these
+            logger.info(f"torchvision JPEG decode failed, falling back to PIL: {str(e)}")
+
+    # PIL is only needed for non-JPEG (or unusual JPEG) uploads; import lazily to keep startup lean
+    import io
+    from PIL import Image, ImageOps
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(contents)))
+    # Convert to RGB if necessary
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.array(image)
+
+def parse_results(results, index: int = 0) -> List[Dict]:
+    """
+    Parse YOLO results for one image of a batch into structured JSON format
+    """
+    # Extract predictions: (N, 6) rows of xmin, ymin, xmax, ymax, confidence, class
+    predictions = results.xyxy[index].cpu().numpy().astype(np.float64)
 
     # Log raw predictions for debugging
     logger.info(f"Raw predictions:\n{predictions}")
 
-    for idx, row in predictions.iterrows():
-        detection = {
+    boxes = np.round(predictions[:, :4], 2).tolist()
+    centers = np.round((predictions[:, 0:2] + predictions[:, 2:4]) / 2, 2).tolist()
+    confidences = np.round(predictions[:, 4], 4).tolist()
+    names = [results.names[c] for c in predictions[:, 5].astype(int).tolist()]
+
+    return [
+        {
             "object_id": idx + 1,
-            "class": row['name'],
-            "confidence": round(float(row['confidence']), 4),
+            "class": name,
+            "confidence": confidence,
             "bounding_box": {
-                "x_min": round(float(row['xmin']), 2),
-                "y_min": round(float(row['ymin']), 2),
-                "x_max": round(float(row['xmax']), 2),
-                "y_max": round(float(row['ymax']), 2)
+                "x_min": box[0],
+                "y_min": box[1],
+                "x_max": box[2],
+                "y_max": box[3]
             },
             "center": {
-                "x": round((float(row['xmin']) + float(row['xmax'])) / 2, 2),
-                "y": round((float(row['ymin']) + float(row['ymax'])) / 2, 2)
+                "x": center[0],
+                "y": center[1]
             }
         }
-        detections.append(detection)
-
-    return detections
-
-@app.get("/results/{filename}")
-async def get_result_image(filename: str):
-    """
-    Serve result images
-    """
-    file_path = os.path.join(RESULTS_DIR, filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    else:
-        raise HTTPException(status_code=404, detail="Result image not found")
+        for idx, (name, confidence, box, center) in enumerate(zip(names, confidences, boxes, centers))
+    ]
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # One worker per GPU: each worker loads its own model and batching queue
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    uvicorn.run("app:app", host="0.0.0.0", port=8001, workers=workers,
+                loop="uvloop", http="httptools", log_level="info")
\ No newline at end of file
@@ -1,12 +1,17 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, Response, request, render_template, send_from_directory
 from werkzeug.utils import secure_filename
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
 import os
 import logging
 from datetime import datetime
 from PIL import Image
 import io
 import pathlib
+import threading
+from blake3 import blake3
+from cachetools import LRUCache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,25 +29,63 @@ app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 AI_BACKEND_URL = os.getenv('AI_BACKEND_URL', 'http://127.0.0.1:8001')
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
+# Keep-alive connection pool to the AI backend, shared across requests
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+# Detection results keyed by BLAKE3 hash of the uploaded bytes
+RESULT_CACHE_SIZE = 1024
+result_cache = LRUCache(maxsize=RESULT_CACHE_SIZE)
+result_cache_lock = threading.Lock()
+
 # Startup log
 logger.info("Starting UI Backend Server...")
 logger.info(f"AI Backend URL: {AI_BACKEND_URL}")
 
+def ojson(data):
+    """Build a JSON response encoded with orjson"""
+    return Response(orjson.dumps(data), mimetype='application/json')
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def validate_image(file_path):
-    """Validate that the file is a proper image"""
+def validate_image(fp):
+    """Validate that the file (path or file object) is a proper image"""
     try:
-        with Image.open(file_path) as img:
+        with Image.open(fp) as img:
+            # Format and size come from the header parsed by open(); verify()
+            # only invalidates the pixel data, so one open is enough
+            img_format, img_size = img.format, img.size
             img.verify()
-        with Image.open(file_path) as img:
-            return True, img.format, img.size
+            return True, img_format, img_size
     except Exception as e:
         return False, None, None
 
+def save_upload(filepath, contents):
+    """Archive an uploaded image to the uploads folder"""
+    try:
+        with open(filepath, 'wb') as f:
+            f.write(contents)
+        logger.info(f"File saved: {filepath}")
+    except Exception as e:
+        logger.error(f"Error saving upload {filepath}: {str(e)}")
+
+def get_cached_result(digest):
+    """Return the cached detection result for an upload hash if its result image still exists"""
+    with result_cache_lock:
+        result = result_cache.get(digest)
+    if result is None:
+        return None
+    result_image = STATIC_DIR / result['result_image'][len('/static/'):]
+    if not result_image.exists():
+        with result_cache_lock:
+            result_cache.pop(digest, None)
+        return None
+    return result
+
 @app.route('/')
 def index():
     """Serve the web interface"""
@@ -52,13 +95,13 @@ def index():
 def health():
     """Health check endpoint"""
     try:
-        response = requests.get(f"{AI_BACKEND_URL}/health", timeout=5)
-        ai_status = response.json() if response.status_code == 200 else {"status": "unreachable"}
+        response = SESSION.get(f"{AI_BACKEND_URL}/health", timeout=5)
+        ai_status = orjson.loads(response.content) if response.status_code == 200 else {"status": "unreachable"}
     except Exception as e:
         logger.error(f"AI backend health check failed: {str(e)}")
         ai_status = {"status": "unreachable", "error": str(e)}
     
-    return jsonify({
+    return ojson({
         "status": "healthy",
         "service": "UI Backend",
         "timestamp": datetime.now().isoformat(),
@@ -74,7 +117,7 @@ def upload():
         # Check if image is in request
         if 'image' not in request.files:
             logger.error("No image file in request")
-            return jsonify({
+            return ojson({
                 "success": False,
                 "error": "No image file provided"
             }), 400
@@ -84,7 +127,7 @@ def upload():
         # Check if file was selected
         if file.filename == '':
             logger.error("Empty filename")
-            return jsonify({
+            return ojson({
                 "success": False,
                 "error": "No file selected"
             }), 400
@@ -92,7 +135,7 @@ def upload():
         # Validate file type
         if not allowed_file(file.filename):
             logger.error(f"Invalid file type: {file.filename}")
-            return jsonify({
+            return ojson({
                 "success": False,
                 "error": "Invalid file type. Allowed: png, jpg, jpeg, gif, bmp, webp"
             }), 400
@@ -104,36 +147,43 @@ def upload():
         unique_filename = f"{timestamp}_{base_name}{ext}"
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
         
-        # Save file
-        file.save(filepath)
-        logger.info(f"File saved: {filepath}")
+        # Read upload into memory
+        contents = file.stream.read()
         
         # Validate image
-        is_valid, img_format, img_size = validate_image(filepath)
+        is_valid, img_format, img_size = validate_image(io.BytesIO(contents))
         if not is_valid:
-            os.remove(filepath)
             logger.error("Invalid image file")
-            return jsonify({
+            return ojson({
                 "success": False,
                 "error": "Invalid image file"
             }), 400
         
         logger.info(f"Image validated: {img_format}, {img_size}")
         
+        # Archive the upload off the request path
+        threading.Thread(target=save_upload, args=(filepath, contents), daemon=True).start()
+        
+        # Serve repeated uploads from the result cache
+        digest = blake3(contents).hexdigest()
+        cached = get_cached_result(digest)
+        if cached is not None:
+            logger.info(f"Cache hit: {digest}")
+            return ojson({**cached, "image_name": filename})
+        
         # Forward to AI backend
         try:
-            with open(filepath, 'rb') as f:
-                files = {'file': (filename, f, file.content_type or 'application/octet-stream')}
-                logger.info(f"Sending to AI backend: {AI_BACKEND_URL}/detect")
-                
-                response = requests.post(
-                    f"{AI_BACKEND_URL}/detect",
-                    files=files,
-                    timeout=30
-                )
+            files = {'file': (filename, contents, file.content_type or 'application/octet-stream')}
+            logger.info(f"Sending to AI backend: {AI_BACKEND_URL}/detect")
+            
+            response = SESSION.post(
+                f"{AI_BACKEND_URL}/detect",
+                files=files,
+                timeout=30
+            )
             
             if response.status_code == 200:
-                result = response.json()
+                result = orjson.loads(response.content)
                 logger.info(f"Detection successful: {result.get('detections_count', 0)} objects found")
                 
                 # Ensure the response has all required fields
@@ -144,36 +194,40 @@ def upload():
                 if 'detections_count' not in result:
                     result['detections_count'] = len(result.get('detections', []))
                 
-                return jsonify(result)
+                if 'result_image' in result:
+                    with result_cache_lock:
+                        result_cache[digest] = result
+                
+                return ojson(result)
             else:
                 logger.error(f"AI backend error: {response.status_code} - {response.text}")
-                return jsonify({
+                return ojson({
                     "success": False,
                     "error": f"AI backend error: {response.text}"
                 }), response.status_code
                 
         except requests.exceptions.Timeout:
             logger.error("AI backend timeout")
-            return jsonify({
+            return ojson({
                 "success": False,
                 "error": "AI backend request timeout"
             }), 504
         except requests.exceptions.ConnectionError:
             logger.error("Cannot connect to AI backend")
-            return jsonify({
+            return ojson({
                 "success": False,
                 "error": "Cannot connect to AI backend service. Please ensure it's running."
             }), 503
         except Exception as e:
             logger.error(f"Error forwarding to AI backend: {str(e)}")
-            return jsonify({
+            return ojson({
                 "success": False,
                 "error": f"Error communicating with AI backend: {str(e)}"
             }), 500
             
     except Exception as e:
         logger.error(f"Error during upload/detection: {str(e)}")
-        return jsonify({
+        return ojson({
             "success": False,
             "error": f"Internal server error: {str(e)}"
         }), 500
@@ -181,7 +235,4 @@ def upload():
 @app.route('/object-detection-microservice/static/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded files"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
\ No newline at end of file